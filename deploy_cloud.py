@@ -3,20 +3,44 @@
 """
 智能环境控制系统 - 云端部署版本
 支持公网访问和二维码生成
+
+开发时直接运行本文件；生产部署使用 eventlet worker：
+    gunicorn -k eventlet -w 1 deploy_cloud:app
+数据保存在进程内存中，只能使用1个worker
 """
 
+# eventlet 需要在其他模块导入之前打补丁；未安装时退回 threading 模式
+try:
+    import eventlet
+    eventlet.monkey_patch()
+    import eventlet.tpool
+    ASYNC_MODE = 'eventlet'
+except ImportError:
+    ASYNC_MODE = 'threading'
+
 from flask import Flask, render_template, jsonify, request, make_response
+from flask.json.provider import DefaultJSONProvider
 from flask_socketio import SocketIO, emit
+import os
 import threading
+import queue
 import time
 import random
+from collections import deque
+from array import array
 import math
-from datetime import datetime
+import struct
 import json
+import logging
 import qrcode
+import qrcode.image.svg
 import io
-import base64
+import urllib.parse
 import socket
+import functools
+import string
+
+log = logging.getLogger(__name__)
 
 try:
     import serial
@@ -24,74 +48,137 @@ try:
     SERIAL_AVAILABLE = True
 except ImportError:
     SERIAL_AVAILABLE = False
-    print("Warning: pyserial not available, using simulation mode only")
+    log.warning("pyserial not available, using simulation mode only")
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # 串口通信协议常量
 SOF = 0xAA
 EOF = 0x55
 
+# 传感器通道顺序（展示数据和历史记录使用）
+SENSOR_KEYS = ('temperature', 'humidity', 'co2', 'light', 'smoke')
+
+# 串口模式未连接时推送的占位数据，前端据此显示 "--"
+NO_SENSOR_DATA = dict.fromkeys(SENSOR_KEYS)
+
+# 传感器数值变化超过该值才推送给前端
+DATA_EPSILON = 0.05
+
+# 环境数据帧：5个小端float（温度、湿度、CO2、第4路传感器、烟雾）
+SENSOR_STRUCT = struct.Struct('<5f')
+
+# 设备在状态字节中对应的位，(设备名, 掩码)
+DEVICE_MASKS = (
+    ('heating', 0x01),
+    ('cooling', 0x02),
+    ('humidify', 0x04),
+    ('dehumidify', 0x08),
+    ('ventilation', 0x10),
+    ('close_vent', 0x20)
+)
+
+# 设备名 -> 掩码
+DEVICE_BITS = dict(DEVICE_MASKS)
+ALL_DEVICE_BITS = sum(DEVICE_BITS.values())
+
+# 自动控制管理的设备，(设备名, 掩码, 事件中的名称)；关闭通风口不参与自动控制
+AUTO_DEVICES = (
+    ('heating', 0x01, '加热系统'),
+    ('cooling', 0x02, '制冷系统'),
+    ('humidify', 0x04, '加湿系统'),
+    ('dehumidify', 0x08, '除湿系统'),
+    ('ventilation', 0x10, '通风系统')
+)
+AUTO_DEVICE_BITS = sum(mask for _, mask, _ in AUTO_DEVICES)
+
+# 历史数据环形缓冲区容量（每2秒一条，约2小时）
+HISTORY_SIZE = 3600
+
+# 历史记录：5个本机字节序float32，与 array('f') 的内存布局一致，顺序同 SENSOR_KEYS
+HISTORY_RECORD = struct.Struct('=5f')
+
+# 接收线程与处理线程之间的帧队列容量
+RX_QUEUE_SIZE = 256
+
+# 串口列表缓存时间（秒），避免前端轮询时反复枚举设备
+PORTS_CACHE_TTL = 2.0
+
+# 超过该长度的数据改用整数折叠计算校验和
+CS_FOLD_THRESHOLD = 64
+
 def calc_cs(data: bytes) -> int:
     """计算校验和"""
-    cs = 0
-    for b in data:
-        cs ^= b
-    return cs & 0xFF
+    if len(data) < CS_FOLD_THRESHOLD:
+        cs = 0
+        for b in data:
+            cs ^= b
+        return cs & 0xFF
+    # 长数据：整体转为大整数后按半宽对折异或，由C层按机器字完成，
+    # 折到8字节以内后再在64位内移位折叠
+    n = int.from_bytes(data, 'little')
+    width = len(data)
+    while width > 8:
+        width = (width + 1) // 2
+        n = (n & ((1 << (width * 8)) - 1)) ^ (n >> (width * 8))
+    n ^= n >> 32
+    n ^= n >> 16
+    n ^= n >> 8
+    return n & 0xFF
 
 def pack_frame(cmd: int, payload: bytes) -> bytes:
     """打包数据帧"""
-    length = 1 + len(payload)
-    body = bytes([length, cmd]) + payload
-    cs = calc_cs(body)
-    return bytes([SOF]) + body + bytes([cs, EOF])
+    n = len(payload)
+    if n == 1:
+        # 设备控制命令只有1字节数据，直接一次构造整帧
+        p = payload[0]
+        return bytes((SOF, 2, cmd, p, 2 ^ cmd ^ p, EOF))
+    buf = bytearray(n + 5)
+    buf[0] = SOF
+    buf[1] = n + 1
+    buf[2] = cmd
+    buf[3:3 + n] = payload
+    buf[3 + n] = calc_cs(memoryview(buf)[1:3 + n])
+    buf[4 + n] = EOF
+    return bytes(buf)
 
 class FrameParser:
     """数据帧解析器"""
     def __init__(self):
-        self.state = 0
-        self.buf = bytearray()
-        self.length = 0
-        self.expected_payload = 0
-        self.payload = bytearray()
-
-    def feed(self, b: int):
-        """输入字节并解析"""
-        if self.state == 0:
-            if b == SOF:
-                self.buf.clear()
-                self.state = 1
-        elif self.state == 1:
-            self.length = b
-            self.buf = bytearray([b])
-            self.state = 2
-        elif self.state == 2:
-            self.buf.append(b)
-            if self.length == 1:
-                self.state = 3
-            else:
-                self.state = 21
-                self.expected_payload = self.length - 1
-                self.payload = bytearray()
-        elif self.state == 21:
-            self.payload.append(b)
-            if len(self.payload) >= self.expected_payload:
-                self.buf += self.payload
-                self.state = 3
-        elif self.state == 3:
-            cs_calc = calc_cs(bytes(self.buf))
-            if cs_calc != b:
-                self.state = 0
-                return None
-            self.state = 4
-        elif self.state == 4:
-            if b == EOF:
-                length = self.buf[0]
-                cmd = self.buf[1]
-                payload = bytes(self.buf[2:2 + (length - 1)])
-                self.state = 0
-                return (cmd, payload)
+        self._rx = bytearray()
+
+    def feed_bulk(self, data: bytes) -> list[tuple[int, bytes]]:
+        """输入一批字节，返回其中解析出的全部完整帧 [(cmd, payload), ...]"""
+        rx = self._rx
+        rx += data
+        frames = []
+        pos = 0
+        size = len(rx)
+        while True:
+            i = rx.find(SOF, pos)
+            if i < 0:
+                pos = size
+                break
+            pos = i
+            if size - i < 2:
+                break
+            length = rx[i + 1]
+            end = i + length + 4  # SOF + 长度 + (命令+数据) + 校验 + EOF
+            if size < end:
+                break
+            if length and rx[end - 2] == calc_cs(rx[i + 1:end - 2]) and rx[end - 1] == EOF:
+                frames.append((rx[i + 2], bytes(rx[i + 3:end - 2])))
+                pos = end
             else:
-                self.state = 0
-        return None
+                # 帧无效，跳过该帧头后重新查找
+                pos = i + 1
+        # 已处理的数据一次性移出缓冲区，只保留未完成的帧
+        del rx[:pos]
+        return frames
 
 class SerialManager:
     """串口管理器"""
@@ -99,22 +186,31 @@ class SerialManager:
         self.callback = callback
         self.ser = None
         self.rx_thread = None
-        self.stop_flag = False
+        self.dispatch_thread = None
+        self.rx_queue = queue.Queue(maxsize=RX_QUEUE_SIZE)
+        self.stop_event = threading.Event()
         self.parser = FrameParser()
         self.connected = False
+        self._ports_cache = ([], None)  # (串口列表, 枚举时间)
 
-    def list_ports(self):
-        """列出可用串口"""
+    def list_ports(self, force=False):
+        """列出可用串口，PORTS_CACHE_TTL 内重复调用直接返回上次结果，force=True 时重新枚举"""
         if not SERIAL_AVAILABLE:
             return []
         
+        now = time.monotonic()
+        ports, listed_at = self._ports_cache
+        if not force and listed_at is not None and now - listed_at < PORTS_CACHE_TTL:
+            return ports
+        
         try:
             ports = []
             for port in serial.tools.list_ports.comports():
                 ports.append(port.device)
+            self._ports_cache = (ports, now)
             return ports
         except Exception as e:
-            print(f"Error listing serial ports: {e}")
+            log.error("Error listing serial ports: %s", e)
             return []
 
     def connect(self, port, baudrate=115200):
@@ -126,9 +222,16 @@ class SerialManager:
             if self.ser and self.ser.is_open:
                 self.disconnect()
             
-            self.ser = serial.Serial(port, baudrate, timeout=1)
+            # 无读超时：接收线程一直阻塞到有数据，断开时由 cancel_read 唤醒
+            self.ser = serial.Serial(port, baudrate, timeout=None)
             self.connected = True
-            self.stop_flag = False
+            self.stop_event.clear()
+            
+            # 处理线程只需启动一次，断开重连后继续复用
+            if not (self.dispatch_thread and self.dispatch_thread.is_alive()):
+                self.dispatch_thread = threading.Thread(target=self._dispatch_worker)
+                self.dispatch_thread.daemon = True
+                self.dispatch_thread.start()
             
             self.rx_thread = threading.Thread(target=self._rx_worker)
             self.rx_thread.daemon = True
@@ -141,7 +244,11 @@ class SerialManager:
     def disconnect(self):
         """断开串口连接"""
         self.connected = False
-        self.stop_flag = True
+        self.stop_event.set()
+        
+        # 唤醒阻塞在 read() 上的接收线程，使其立即退出
+        if self.ser and self.ser.is_open and hasattr(self.ser, 'cancel_read'):
+            self.ser.cancel_read()
         
         if self.rx_thread:
             self.rx_thread.join(timeout=1)
@@ -165,57 +272,154 @@ class SerialManager:
 
     def _rx_worker(self):
         """接收数据线程"""
-        while not self.stop_flag and self.ser and self.ser.is_open:
+        # eventlet 下线程即协程：POSIX 上 pyserial 通过（已打补丁的）select 等待串口 fd，
+        # 只挂起当前协程；Windows 串口不支持 select，阻塞读会卡住整个事件循环，交给真实线程池执行
+        read = self.ser.read
+        if ASYNC_MODE == 'eventlet' and os.name == 'nt':
+            ser = self.ser
+            read = lambda n: eventlet.tpool.execute(ser.read, n)
+        
+        while not self.stop_event.is_set() and self.ser and self.ser.is_open:
             try:
-                if self.ser.in_waiting > 0:
-                    data = self.ser.read(self.ser.in_waiting)
-                    for byte in data:
-                        result = self.parser.feed(byte)
-                        if result and self.callback:
-                            self.callback(result[0], result[1])
-                time.sleep(0.01)
+                # 阻塞等待首字节，再一次性读走缓冲区中已到达的数据
+                head = read(1)
+                if not head:
+                    continue
+                data = head + self.ser.read(self.ser.in_waiting)
+                # 只入队，不在接收线程里处理，避免处理耗时拖慢接收
+                rx_queue = self.rx_queue
+                for frame in self.parser.feed_bulk(data):
+                    if rx_queue.full():
+                        try:
+                            rx_queue.get_nowait()  # 处理跟不上时丢弃最旧的帧
+                        except queue.Empty:
+                            pass
+                    rx_queue.put_nowait(frame)
             except Exception as e:
-                print(f"Serial RX error: {e}")
+                # 主动断开时关闭串口引起的异常无需报告
+                if not self.stop_event.is_set():
+                    log.error("Serial RX error: %s", e)
                 break
 
+    def _dispatch_worker(self):
+        """数据处理线程，按接收顺序把数据帧交给回调"""
+        while True:
+            cmd, payload = self.rx_queue.get()
+            if self.callback:
+                try:
+                    self.callback(cmd, payload)
+                except Exception as e:
+                    log.error("Serial dispatch error: %s", e)
+
+# 本机IP缓存有效期（秒）
+LOCAL_IP_TTL = 60
+_local_ip_cache = (0.0, None)
+
 def get_local_ip():
-    """获取本机IP地址"""
+    """获取本机IP地址（缓存 LOCAL_IP_TTL 秒）"""
+    global _local_ip_cache
+    now = time.monotonic()
+    ts, ip = _local_ip_cache
+    if ip is not None and now - ts < LOCAL_IP_TTL:
+        return ip
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(("8.8.8.8", 80))
         ip = s.getsockname()[0]
         s.close()
-        return ip
     except:
-        return "127.0.0.1"
+        ip = "127.0.0.1"
+    _local_ip_cache = (now, ip)
+    return ip
+
+@functools.lru_cache(maxsize=32)
+def _make_qr_code(url):
+    """生成二维码图片的data URL（按url缓存）"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+    
+    # 输出SVG矢量图，无需光栅化和base64编码
+    img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+    buffer = io.BytesIO()
+    img.save(buffer)
+    # 只转义 data URL 中必须转义的字符，保持体积接近原始SVG
+    svg = urllib.parse.quote(buffer.getvalue().decode('utf-8'), safe=" /:=,.'")
+    
+    return f"data:image/svg+xml;charset=utf-8,{svg}"
 
 def generate_qr_code(url):
     """生成二维码"""
     try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # 转换为base64
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        
-        return f"data:image/png;base64,{img_str}"
+        return _make_qr_code(url)
     except Exception as e:
-        print(f"QR Code generation error: {e}")
+        log.error("QR Code generation error: %s", e)
         return None
 
+class OrjsonProvider(DefaultJSONProvider):
+    """使用 orjson 序列化的 Flask JSON 提供者"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """jsonify 直接使用 orjson 生成的字节作为响应体，省去 str 编解码"""
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype=self.mimetype)
+
+class OrjsonModule:
+    """供 Socket.IO 使用的 orjson 包装，接口与标准库 json 一致"""
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'environment_control_secret'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio_options = {}
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
+    socketio_options['json'] = OrjsonModule
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, **socketio_options)
+
+def simulate_sensors(t, r_temp, r_hum, r_co2, r_light, r_smoke):
+    """根据时间和随机扰动计算一组模拟传感器数值，顺序同 SENSOR_KEYS"""
+    sin = math.sin
+    temperature = 25 + sin(t / 60) * 3 + r_temp
+    humidity = max(0, min(100, 60 + math.cos(t / 80) * 10 + r_hum))
+    co2 = max(300, 450 + sin(t / 120) * 200 + r_co2)
+    light = max(50, 400 + sin(t / 150) * 200 + r_light)
+    smoke = max(0, r_smoke)
+    return temperature, humidity, co2, light, smoke
+
+def compute_want(t, h, co2, t_min, t_max, h_min, h_max, co2_max):
+    """根据传感器数值和阈值计算自动控制设备的期望状态字节，位定义同 AUTO_DEVICES"""
+    return ((t < t_min)
+            | (t_min <= t > t_max) << 1
+            | (h < h_min) << 2
+            | (h_min <= h > h_max) << 3
+            | (co2 > co2_max) << 4)
+
+def format_event(event):
+    """把事件元组 (id, 时间戳, 类型, 消息, 级别) 转换为推送给前端的字典"""
+    event_id, ts, event_type, message, level = event
+    return {
+        'timestamp': time.strftime("%H:%M:%S", time.localtime(ts)),
+        'type': event_type,
+        'message': message,
+        'level': level,
+        'id': event_id
+    }
 
 class EnvironmentData:
     """环境数据管理"""
@@ -227,7 +431,9 @@ class EnvironmentData:
             'light': 350.0,
             'smoke': 0.0
         }
-        self.history = []
+        # 历史数据：float32 环形缓冲区，每条按 SENSOR_KEYS 顺序连续存放
+        self.history = array('f', bytes(4 * len(SENSOR_KEYS) * HISTORY_SIZE))
+        self.history_count = 0  # 累计写入条数
         self.device_states = {
             "heating": False,
             "cooling": False,
@@ -236,6 +442,8 @@ class EnvironmentData:
             "ventilation": False,
             "close_vent": False
         }
+        self._device_bitmask = 0  # 与 device_states 同步的设备状态字节
+        self._device_lock = threading.Lock()  # 修改 device_states 和 _device_bitmask 时持有
         self.thresholds = {
             'temperature': {'min': 20, 'max': 26},
             'humidity': {'min': 40, 'max': 70},
@@ -243,143 +451,184 @@ class EnvironmentData:
             'light': {'min': 100, 'max': 800},
             'smoke': {'max': 50}
         }
-        self.events = []
+        self.event_count = 0  # 累计事件数，同时作为事件id
+        self.events = deque(maxlen=100)
+        self.recent_events = deque(maxlen=10)  # 最近10条，供实时推送和接口直接使用
         self.running = True
+        # 上次推送给前端的内容，用于只推送变化部分
+        self._last_sent_data = {}
+        self._last_sent_device_bits = None
+        self._last_sent_event_count = 0
+        self._last_sent_mode = None
+        self._last_sent_connected = None
+        # 推送内容复用同一组字典；emit 时立即序列化，下个周期再清空重填
+        self._update = {}
+        self._delta = {}
         self.use_simulation = True
         self.data_mode = 'simulation'
         
         self.serial_manager = SerialManager(callback=self.on_serial_data)
         
     def add_event(self, event_type, message, level="INFO"):
-        """添加事件记录"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        event = {
-            'timestamp': timestamp,
-            'type': event_type,
-            'message': message,
-            'level': level
-        }
+        """添加事件记录；只保存原始元组，推送或查询时再由 format_event 格式化"""
+        self.event_count += 1
+        event = (self.event_count, time.time(), event_type, message, level)
         self.events.append(event)
-        if len(self.events) > 100:
-            self.events.pop(0)
+        self.recent_events.append(event)
+    
+    def format_events(self, n=None):
+        """最近 n 条事件（默认全部最近事件）的字典列表，按时间先后排列"""
+        events = list(self.recent_events)
+        if n is not None:
+            events = events[-n:]
+        return [format_event(e) for e in events]
     
     def simulate_data(self):
         """模拟环境数据"""
         while self.running:
             if self.data_mode == 'simulation':
-                base_temp = 25 + math.sin(time.time() / 60) * 3
-                self.data['temperature'] = base_temp + random.uniform(-1, 1)
-                
-                base_humidity = 60 + math.cos(time.time() / 80) * 10
-                self.data['humidity'] = max(0, min(100, base_humidity + random.uniform(-2, 2)))
-                
-                base_co2 = 450 + math.sin(time.time() / 120) * 200
-                self.data['co2'] = max(300, base_co2 + random.uniform(-20, 20))
-                
-                base_light = 400 + math.sin(time.time() / 150) * 200
-                self.data['light'] = max(50, base_light + random.uniform(-30, 30))
-                
-                self.data['smoke'] = max(0, random.uniform(0, 10))
+                uniform = random.uniform
+                self.publish_data(simulate_sensors(
+                    time.time(),
+                    uniform(-1, 1), uniform(-2, 2), uniform(-20, 20),
+                    uniform(-30, 30), uniform(0, 10)))
             
             self.auto_control()
             
-            data_to_send = self.data.copy()
+            if self.current_data() is not NO_SENSOR_DATA:
+                self.record_history()
             
-            if self.data_mode == 'serial' and not self.serial_manager.connected:
-                data_to_send = {
-                    'temperature': None,
-                    'humidity': None,
-                    'co2': None,
-                    'light': None,
-                    'smoke': None
-                }
+            if _client_count:
+                update = self.build_update()
+                if update:
+                    socketio.emit('data_update', update)
             
-            socketio.emit('data_update', {
-                'data': data_to_send,
-                'devices': self.device_states,
-                'events': self.events[-5:],
-                'data_mode': self.data_mode,
-                'serial_connected': self.serial_manager.connected
-            })
-            
-            time.sleep(2)
+            socketio.sleep(2)
     
-    def auto_control(self):
-        """自动控制设备"""
-        changes = []
+    def publish_data(self, values, **extra):
+        """整体替换传感器数据（values 按 SENSOR_KEYS 顺序，extra 为附加数据）；只做一次赋值，其他线程读到的总是完整的一组数据"""
+        t, h, c, l, s = values
+        data = {'temperature': t, 'humidity': h, 'co2': c, 'light': l, 'smoke': s}
+        if extra:
+            data.update(extra)
+        self.data = data
+    
+    def record_history(self):
+        """把当前传感器数据写入历史缓冲区，写满后覆盖最旧的记录"""
+        offset = (self.history_count % HISTORY_SIZE) * HISTORY_RECORD.size
+        d = self.data
+        HISTORY_RECORD.pack_into(self.history, offset, d['temperature'], d['humidity'], d['co2'], d['light'], d['smoke'])
+        self.history_count += 1
+    
+    def recent_history(self, n):
+        """最近 n 条历史数据，按时间先后排列，每条为 SENSOR_KEYS 顺序的元组"""
+        n = min(n, self.history_count, HISTORY_SIZE)
+        start = self.history_count - n
+        h = self.history
+        size = HISTORY_RECORD.size
+        unpack_from = HISTORY_RECORD.unpack_from
+        return [unpack_from(h, (k % HISTORY_SIZE) * size) for k in range(start, start + n)]
+    
+    def current_data(self):
+        """当前要展示的传感器数据，串口模式未连接时为占位数据（前端显示--）"""
+        if self.data_mode == 'serial' and not self.serial_manager.connected:
+            return NO_SENSOR_DATA
+        return self.data
+    
+    def snapshot(self):
+        """完整状态，用于新客户端连接时的首次推送（full 标记，前端收到后才开始合并增量）"""
+        return {
+            'full': True,
+            'data': self.current_data(),
+            'devices': self.device_states,
+            'events': self.format_events(5),
+            'data_mode': self.data_mode,
+            'serial_connected': self.serial_manager.connected
+        }
+    
+    def build_update(self):
+        """与上次推送相比发生变化的部分，前端按字段合并（返回的字典下次调用时会被复用）"""
+        update = self._update
+        update.clear()
         
-        if self.data['temperature'] < self.thresholds['temperature']['min']:
-            if not self.device_states['heating']:
-                self.device_states['heating'] = True
-                self.device_states['cooling'] = False
-                changes.append("启动加热系统")
-        elif self.data['temperature'] > self.thresholds['temperature']['max']:
-            if not self.device_states['cooling']:
-                self.device_states['cooling'] = True
-                self.device_states['heating'] = False
-                changes.append("启动制冷系统")
-        else:
-            if self.device_states['heating']:
-                self.device_states['heating'] = False
-                changes.append("关闭加热系统")
-            if self.device_states['cooling']:
-                self.device_states['cooling'] = False
-                changes.append("关闭制冷系统")
+        last = self._last_sent_data
+        delta = self._delta
+        delta.clear()
+        for key, value in self.current_data().items():
+            old = last.get(key)
+            if value is None or old is None:
+                changed = value is not old
+            else:
+                changed = abs(value - old) > DATA_EPSILON
+            if changed:
+                delta[key] = value
+                last[key] = value
+        if delta:
+            update['data'] = delta
         
-        if self.data['humidity'] < self.thresholds['humidity']['min']:
-            if not self.device_states['humidify']:
-                self.device_states['humidify'] = True
-                self.device_states['dehumidify'] = False
-                changes.append("启动加湿系统")
-        elif self.data['humidity'] > self.thresholds['humidity']['max']:
-            if not self.device_states['dehumidify']:
-                self.device_states['dehumidify'] = True
-                self.device_states['humidify'] = False
-                changes.append("启动除湿系统")
-        else:
-            if self.device_states['humidify']:
-                self.device_states['humidify'] = False
-                changes.append("关闭加湿系统")
-            if self.device_states['dehumidify']:
-                self.device_states['dehumidify'] = False
-                changes.append("关闭除湿系统")
+        if self._device_bitmask != self._last_sent_device_bits:
+            self._last_sent_device_bits = self._device_bitmask
+            update['devices'] = self.device_states
         
-        if self.data['co2'] > self.thresholds['co2']['max']:
-            if not self.device_states['ventilation']:
-                self.device_states['ventilation'] = True
-                changes.append("启动通风系统")
-        else:
-            if self.device_states['ventilation']:
-                self.device_states['ventilation'] = False
-                changes.append("关闭通风系统")
+        new_events = self.event_count - self._last_sent_event_count
+        if new_events:
+            self._last_sent_event_count = self.event_count
+            update['events'] = self.format_events(new_events)
+        
+        if self.data_mode != self._last_sent_mode:
+            self._last_sent_mode = self.data_mode
+            update['data_mode'] = self.data_mode
+        
+        serial_connected = self.serial_manager.connected
+        if serial_connected != self._last_sent_connected:
+            self._last_sent_connected = serial_connected
+            update['serial_connected'] = serial_connected
         
-        for change in changes:
-            self.add_event("DEVICE", change, "INFO")
+        return update
+    
+    def auto_control(self):
+        """自动控制设备"""
+        d = self.data
+        th = self.thresholds
+        want = compute_want(
+            d['temperature'], d['humidity'], d['co2'],
+            th['temperature']['min'], th['temperature']['max'],
+            th['humidity']['min'], th['humidity']['max'],
+            th['co2']['max'])
+        
+        # 读取、比较和写回在同一把锁内完成，避免覆盖其他线程同时做的修改
+        with self._device_lock:
+            diff = (want ^ self._device_bitmask) & AUTO_DEVICE_BITS
+            if not diff:
+                return
+            self._device_bitmask ^= diff
+            states = self.device_states
+            for device, mask, name in AUTO_DEVICES:
+                if diff & mask:
+                    states[device] = bool(want & mask)
+        
+        for device, mask, name in AUTO_DEVICES:
+            if diff & mask:
+                self.add_event("DEVICE", f"{'启动' if want & mask else '关闭'}{name}", "INFO")
     
     def on_serial_data(self, cmd, payload):
         """处理串口接收到的数据"""
         try:
             if cmd == 0x01:
-                if len(payload) >= 20:
-                    import struct
-                    values = struct.unpack('<5f', payload[:20])
-                    self.data['temperature'] = values[0]
-                    self.data['humidity'] = values[1]
-                    self.data['co2'] = values[2]
-                    self.data['pm25'] = values[3]
-                    self.data['smoke'] = values[4]
+                if len(payload) >= SENSOR_STRUCT.size:
+                    t, h, c, pm25, s = SENSOR_STRUCT.unpack_from(payload)
+                    self.publish_data((t, h, c, self.data['light'], s), pm25=pm25)  # 光照沿用当前值
                     
                     self.add_event("SERIAL", "接收到环境数据", "INFO")
                     
             elif cmd == 0x02:
                 if len(payload) >= 1:
                     device_byte = payload[0]
-                    self.device_states['heating'] = bool(device_byte & 0x01)
-                    self.device_states['cooling'] = bool(device_byte & 0x02)
-                    self.device_states['humidify'] = bool(device_byte & 0x04)
-                    self.device_states['dehumidify'] = bool(device_byte & 0x08)
-                    self.device_states['ventilation'] = bool(device_byte & 0x10)
-                    self.device_states['close_vent'] = bool(device_byte & 0x20)
+                    device_states = self.device_states
+                    with self._device_lock:
+                        for dev, mask in DEVICE_MASKS:
+                            device_states[dev] = bool(device_byte & mask)
+                        self._device_bitmask = device_byte & ALL_DEVICE_BITS
                     
                     self.add_event("SERIAL", "接收到设备状态", "INFO")
                     
@@ -408,28 +657,24 @@ class EnvironmentData:
         """获取当前数据模式"""
         return self.data_mode
 
+    def set_device(self, device, on):
+        """设置设备状态，同时更新设备状态字节"""
+        with self._device_lock:
+            self.device_states[device] = on
+            if on:
+                self._device_bitmask |= DEVICE_BITS[device]
+            else:
+                self._device_bitmask &= ~DEVICE_BITS[device]
+    
     def send_device_command(self, device, state):
         """发送设备控制命令到串口"""
         if not self.serial_manager.connected:
             return False, "串口未连接"
         
         try:
-            device_map = {
-                'heating': 0x01,
-                'cooling': 0x02,
-                'humidify': 0x04,
-                'dehumidify': 0x08,
-                'ventilation': 0x10,
-                'close_vent': 0x20
-            }
-            
-            if device in device_map:
-                current_state = 0
-                for dev, is_on in self.device_states.items():
-                    if dev == device:
-                        is_on = state
-                    if is_on and dev in device_map:
-                        current_state |= device_map[dev]
+            mask = DEVICE_BITS.get(device)
+            if mask is not None:
+                current_state = (self._device_bitmask & ~mask) | (mask if state else 0)
                 
                 payload = bytes([current_state])
                 success, msg = self.serial_manager.send_command(0x03, payload)
@@ -446,30 +691,52 @@ class EnvironmentData:
 
 env_data = EnvironmentData()
 
+# 当前连接的 WebSocket 客户端数，为0时模拟循环不推送数据
+_client_count = 0
+_client_lock = threading.Lock()
+
+# 后台任务只启动一次
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_tasks():
+    """启动数据模拟任务；gunicorn 部署不经过 __main__，在首个 HTTP 请求或客户端连接时启动"""
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    
+    socketio.start_background_task(env_data.simulate_data)
+    
+    # 添加初始事件
+    env_data.add_event("SYSTEM", "智能环境控制系统启动", "SYSTEM")
+    env_data.add_event("SYSTEM", "开始环境数据监控", "INFO")
+
+@app.before_request
+def ensure_background_tasks():
+    """没有 WebSocket 客户端时，API 请求也能启动后台任务"""
+    if not _background_started:
+        start_background_tasks()
+
+# 主页面渲染结果，首次请求时生成并缓存
+_index_html = None
+
 @app.route('/')
 def index():
     """主页面"""
-    response = make_response(render_template('index.html'))
+    global _index_html
+    if _index_html is None:
+        _index_html = render_template('index.html').encode('utf-8')
+    response = make_response(_index_html)
+    response.headers['Content-Type'] = 'text/html; charset=utf-8'
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     return response
 
-@app.route('/qr')
-def qr_page():
-    """二维码页面"""
-    local_ip = get_local_ip()
-    port = 5000
-    
-    # 生成访问地址
-    local_url = f"http://localhost:{port}"
-    network_url = f"http://{local_ip}:{port}"
-    
-    # 生成二维码
-    qr_code_local = generate_qr_code(local_url)
-    qr_code_network = generate_qr_code(network_url)
-    
-    return f"""
+# 二维码页面模板
+QR_PAGE_TEMPLATE = string.Template("""
     <!DOCTYPE html>
     <html lang="zh-CN">
     <head>
@@ -477,53 +744,55 @@ def qr_page():
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>智能环境控制系统 - 访问地址</title>
         <style>
-            body {{
+            body {
                 font-family: 'Microsoft YaHei UI', Arial, sans-serif;
                 background: linear-gradient(135deg, #1a1a2e 0%, #16213e 100%);
                 color: #ecf0f1;
                 margin: 0;
                 padding: 20px;
                 min-height: 100vh;
-            }}
-            .container {{
+            }
+            .container {
                 max-width: 800px;
                 margin: 0 auto;
                 text-align: center;
-            }}
-            h1 {{
+            }
+            h1 {
                 color: #3282b8;
                 margin-bottom: 30px;
-            }}
-            .qr-section {{
+            }
+            .qr-section {
                 display: flex;
                 justify-content: space-around;
                 flex-wrap: wrap;
                 gap: 30px;
                 margin: 30px 0;
-            }}
-            .qr-card {{
+            }
+            .qr-card {
                 background: rgba(22, 33, 62, 0.9);
                 border: 1px solid rgba(255, 255, 255, 0.1);
                 border-radius: 16px;
                 padding: 20px;
                 min-width: 300px;
-            }}
-            .qr-code {{
+            }
+            .qr-code {
                 margin: 20px 0;
-            }}
-            .qr-code img {{
+            }
+            .qr-code img {
+                width: 200px;
                 max-width: 200px;
+                background: #fff;
                 border-radius: 8px;
-            }}
-            .url {{
+            }
+            .url {
                 background: rgba(255, 255, 255, 0.1);
                 padding: 10px;
                 border-radius: 8px;
                 font-family: monospace;
                 word-break: break-all;
                 margin: 10px 0;
-            }}
-            .btn {{
+            }
+            .btn {
                 display: inline-block;
                 padding: 12px 24px;
                 background: linear-gradient(135deg, #3282b8, #0f4c75);
@@ -532,18 +801,18 @@ def qr_page():
                 border-radius: 8px;
                 margin: 10px;
                 transition: all 0.3s ease;
-            }}
-            .btn:hover {{
+            }
+            .btn:hover {
                 transform: translateY(-2px);
                 box-shadow: 0 8px 25px rgba(50, 130, 184, 0.4);
-            }}
-            .info {{
+            }
+            .info {
                 background: rgba(52, 152, 219, 0.2);
                 border: 1px solid rgba(52, 152, 219, 0.3);
                 border-radius: 8px;
                 padding: 15px;
                 margin: 20px 0;
-            }}
+            }
         </style>
     </head>
     <body>
@@ -554,20 +823,20 @@ def qr_page():
             <div class="qr-section">
                 <div class="qr-card">
                     <h3>💻 本地访问</h3>
-                    <div class="url">{local_url}</div>
+                    <div class="url">$local_url</div>
                     <div class="qr-code">
-                        <img src="{qr_code_local}" alt="本地访问二维码">
+                        <img src="$qr_code_local" alt="本地访问二维码">
                     </div>
-                    <a href="{local_url}" class="btn" target="_blank">直接访问</a>
+                    <a href="$local_url" class="btn" target="_blank">直接访问</a>
                 </div>
                 
                 <div class="qr-card">
                     <h3>🌐 网络访问</h3>
-                    <div class="url">{network_url}</div>
+                    <div class="url">$network_url</div>
                     <div class="qr-code">
-                        <img src="{qr_code_network}" alt="网络访问二维码">
+                        <img src="$qr_code_network" alt="网络访问二维码">
                     </div>
-                    <a href="{network_url}" class="btn" target="_blank">直接访问</a>
+                    <a href="$network_url" class="btn" target="_blank">直接访问</a>
                 </div>
             </div>
             
@@ -582,7 +851,43 @@ def qr_page():
         </div>
     </body>
     </html>
-    """
+    """)
+
+# 二维码页面缓存，键为 (local_ip, port)
+_qr_page_cache = {}
+
+def render_qr_page(local_ip, port):
+    """生成二维码页面HTML，返回 (html, 二维码是否全部生成成功)"""
+    # 生成访问地址
+    local_url = f"http://localhost:{port}"
+    network_url = f"http://{local_ip}:{port}"
+    
+    # 生成二维码
+    qr_code_local = generate_qr_code(local_url)
+    qr_code_network = generate_qr_code(network_url)
+    complete = qr_code_local is not None and qr_code_network is not None
+    
+    html = QR_PAGE_TEMPLATE.substitute(
+        local_url=local_url,
+        network_url=network_url,
+        qr_code_local=qr_code_local,
+        qr_code_network=qr_code_network
+    )
+    return html, complete
+
+def get_qr_page(local_ip, port):
+    """获取二维码页面HTML（按 (local_ip, port) 缓存）"""
+    html = _qr_page_cache.get((local_ip, port))
+    if html is None:
+        html, complete = render_qr_page(local_ip, port)
+        if complete:  # 二维码生成失败时不缓存，下次请求重试
+            _qr_page_cache[(local_ip, port)] = html
+    return html
+
+@app.route('/qr')
+def qr_page():
+    """二维码页面"""
+    return get_qr_page(get_local_ip(), 5000)
 
 @app.route('/api/data')
 def get_data():
@@ -591,7 +896,16 @@ def get_data():
         'data': env_data.data,
         'devices': env_data.device_states,
         'thresholds': env_data.thresholds,
-        'events': env_data.events[-10:]
+        'events': env_data.format_events()
+    })
+
+@app.route('/api/history')
+def get_history():
+    """获取最近的历史数据，?n= 指定条数（默认300条，约10分钟）"""
+    n = request.args.get('n', 300, type=int)
+    return jsonify({
+        'keys': SENSOR_KEYS,
+        'history': env_data.recent_history(max(n, 0))
     })
 
 @app.route('/api/control', methods=['POST'])
@@ -603,7 +917,7 @@ def control_device():
     
     if device in env_data.device_states:
         old_state = env_data.device_states[device]
-        env_data.device_states[device] = (action == 'on')
+        env_data.set_device(device, action == 'on')
         
         if old_state != env_data.device_states[device]:
             device_names = {
@@ -640,9 +954,10 @@ def update_threshold():
 
 @app.route('/api/serial/ports')
 def list_serial_ports():
-    """获取可用串口列表"""
+    """获取可用串口列表，?force=1 时跳过缓存重新枚举"""
     try:
-        ports = env_data.serial_manager.list_ports()
+        force = request.args.get('force') == '1'
+        ports = env_data.serial_manager.list_ports(force)
         return jsonify({
             'success': True,
             'ports': ports,
@@ -731,27 +1046,34 @@ def data_mode():
 @socketio.on('connect')
 def handle_connect():
     """WebSocket连接处理"""
-    print('Client connected')
+    global _client_count
+    log.info('Client connected')
+    with _client_lock:
+        _client_count += 1
+    start_background_tasks()
     emit('connected', {'data': 'Connected to Environment Control System'})
+    emit('data_update', env_data.snapshot())  # 之后只推送变化部分，先发一次完整状态
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """WebSocket断开处理"""
-    print('Client disconnected')
+    global _client_count
+    log.info('Client disconnected')
+    with _client_lock:
+        _client_count -= 1
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    
     # 获取网络信息
     local_ip = get_local_ip()
     port = 5000
     
-    # 启动数据模拟线程
-    data_thread = threading.Thread(target=env_data.simulate_data)
-    data_thread.daemon = True
-    data_thread.start()
+    # 预先生成二维码页面
+    get_qr_page(local_ip, port)
     
-    # 添加初始事件
-    env_data.add_event("SYSTEM", "智能环境控制系统启动", "SYSTEM")
-    env_data.add_event("SYSTEM", "开始环境数据监控", "INFO")
+    # 启动数据模拟任务
+    start_background_tasks()
     
     # 显示启动信息
     print("=" * 80)